@@ -1,5 +1,5 @@
-MRTRIX_VERSIONS = ["3.0.4-10-gf633dfd7"]
+MRTRIX_VERSIONS = frozenset({"3.0.4-10-gf633dfd7"})
 
-NIFTYREG_VERSIONS = ["1.5.59"]
+NIFTYREG_VERSIONS = frozenset({"1.5.59"})
 
 DEFAULT_NIFTYREG = "/store/apps/niftyreg/bin"
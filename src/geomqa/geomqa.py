@@ -1,24 +1,54 @@
 """Measure Geometric Distortion of MRI of Large Field-of-View Cylindrical Phantom"""
 
 import argparse
+import functools
+import io
+import os
 import pathlib
-import re
 import subprocess as sp
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import importlib_metadata as metadata
+import matplotlib
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
+from matplotlib.ticker import FormatStrFormatter
 
 import geomqa.config as config
 import geomqa.vercheck as vercheck
 
+# figures are only saved to file so use the non-interactive Agg backend
+matplotlib.use("Agg")
+
 try:
     __version__ = metadata.version("geomqa")
 except metadata.PackageNotFoundError:  # pragma: no cover
     __version__ = "unknown"
 
+# contour plot values, associated colours and format of their labels
+CP_VALS = [0.1, 0.5, 1.0, 1.5, 2, 3, 4, 5, 10, 15, 20]
+CP_COLS = ["gray"] + ["g"] * 2 + ["orange"] + ["r"] * 4 + ["purple"] * 3
+CLABEL_FMT = FormatStrFormatter("%1.1f")
+
+
+def positive_int(string):
+    """
+    Convert a string to a positive integer, for use as an argparse type
+
+    :param string: string representation of integer
+    :type string: str
+    :return: positive integer
+    :rtype: int
+    """
+
+    value = int(string)
+    if value < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % string)
+
+    return value
+
 
 def remove_niigz(string):
     """
@@ -30,13 +60,215 @@ def remove_niigz(string):
     :rtype: str
     """
 
-    string = re.sub(r"\.nii.gz", "", string, re.I)
-    string = re.sub(r"\.nii", "", string, re.I)
+    lower = string.lower()
+    for suffix in (".nii.gz", ".nii"):
+        if lower.endswith(suffix):
+            return string[: -len(suffix)]
+
     return string
 
 
-def contour(b_fp, c_fp, fig_fp):
+def downsample(a, max_dim=256):
+    """
+    Downsample a 2D array by averaging blocks of pixels so that neither
+    dimension exceeds max_dim, cropping any partial blocks at the edges
+
+    Arrays too thin to give at least two blocks along each axis are returned
+    unchanged
+
+    :param a: 2D array
+    :type a: np.ndarray
+    :param max_dim: maximum size of the downsampled array along either axis
+    :type max_dim: int
+    :return: downsampled array and the downsampling factor
+    :rtype: tuple
+    """
+
+    f = -(-max(a.shape) // max_dim)
+    if f == 1 or min(a.shape) < 2 * f:
+        return a, 1
+
+    ny, nx = a.shape[0] // f, a.shape[1] // f
+    return a[: ny * f, : nx * f].reshape(ny, f, nx, f).mean(axis=(1, 3)), f
+
+
+def canonical_axes(img):
+    """
+    Find the axes of an image which are closest to the axes of the canonical
+    (RAS+) orientation
+
+    :param img: image
+    :type img: nib.nifti1.Nifti1Image
+    :return: (image axis, whether it is flipped) for each of the R, A and S axes
+    :rtype: list
+    """
+
+    ornt = nib.io_orientation(img.affine)
+    axes = [int(np.flatnonzero(ornt[:, 0] == axis)[0]) for axis in range(3)]
+    return [(a, bool(ornt[a, 1] < 0)) for a in axes]
+
+
+def load_image(img_fp):
+    """
+    Load an image and its data ready for slicing
+
+    Every read from a compressed image decompresses it again from the start,
+    so compressed images are read in full once, in their stored data type,
+    whereas slices of uncompressed images are read from the memory-mapped file
+    as needed
+
+    :param img_fp: Filepath of image
+    :type img_fp: pathlib.Path
+    :return: image and its data, an array for compressed images or the image's
+        array proxy otherwise
+    :rtype: tuple
+    """
+
+    img = nib.load(img_fp, mmap=True)
+    if img_fp.suffix.lower() in (".gz", ".bz2", ".zst"):
+        return img, np.asanyarray(img.dataobj)
+
+    return img, img.dataobj
+
+
+def central_slice(img, axis, data=None):
+    """
+    Extract the central slice perpendicular to an axis of an image in its
+    closest canonical (RAS+) orientation
+
+    Equivalent to slicing nib.funcs.as_closest_canonical(img) but only the
+    slice, rather than the whole volume, is read from the image
+
+    :param img: image
+    :type img: nib.nifti1.Nifti1Image
+    :param axis: canonical axis perpendicular to the slice i.e. 0 (sagittal),
+        1 (coronal) or 2 (axial)
+    :type axis: int
+    :param data: image data to slice, img.dataobj if None
+    :type data: np.ndarray or nib.arrayproxy.ArrayProxy
+    :return: slice with the remaining canonical axes in RAS order
+    :rtype: np.ndarray
+    """
+
+    img_axes = canonical_axes(img)
+
+    a, flip = img_axes[axis]
+    n = img.shape[a]
+    index = [slice(None)] * 3
+    index[a] = n - 1 - n // 2 if flip else n // 2
+    data = img.dataobj if data is None else data
+    slice_ = np.asarray(data[tuple(index)])
+
+    # put the remaining axes of the slice in canonical order and direction
+    slice_axes = [i for i in range(3) if i != a]
+    in_plane_axes = [img_axes[i] for i in range(3) if i != axis]
+    slice_ = slice_.transpose([slice_axes.index(i) for i, _ in in_plane_axes])
+    for dim, (_, flip) in enumerate(in_plane_axes):
+        if flip:
+            slice_ = np.flip(slice_, dim)
+
+    return slice_
+
+
+def render_view(
+    ax,
+    xax,
+    yax,
+    aspect_ratio,
+    axis_label,
+    base_slice,
+    contour_slice,
+    clim,
+    sizes,
+):
+    """
+    Plot a slice through the base image with a contour plot overlay
+
+    :param ax: Axes to plot on
+    :type ax: matplotlib.axes.Axes
+    :param xax: canonical axis of image plotted horizontally
+    :type xax: int
+    :param yax: canonical axis of image plotted vertically
+    :type yax: int
+    :param aspect_ratio: aspect ratio of axes
+    :type aspect_ratio: float
+    :param axis_label: orientation labels for top, right, bottom and left
+    :type axis_label: str
+    :param base_slice: slice through base image
+    :type base_slice: np.ndarray
+    :param contour_slice: slice through contour image
+    :type contour_slice: np.ndarray
+    :param clim: display range of base image
+    :type clim: np.ndarray
+    :param sizes: canonical dimensions of base image
+    :type sizes: list
+    """
+
+    # there's no benefit in passing the renderer more than twice as many
+    # pixels as the axes cover on the page so downsample larger base slices
+    bbox = ax.get_window_extent()
+    base_slice, base_f = downsample(base_slice, 2 * int(max(bbox.width, bbox.height)))
+
+    # the contour calculation time scales with the number of pixels so use a
+    # downsampled slice, the x and y coordinates are the centres of the
+    # averaged blocks of pixels
+    contour_slice, f = downsample(contour_slice)
+    x = np.arange(contour_slice.shape[1]) * f + (f - 1) / 2.0
+    y = np.arange(contour_slice.shape[0]) * f + (f - 1) / 2.0
+
+    # plot the base image keeping the extent of the original slice
+    ax.imshow(
+        base_slice,
+        extent=(
+            -0.5,
+            base_slice.shape[1] * base_f - 0.5,
+            -0.5,
+            base_slice.shape[0] * base_f - 0.5,
+        ),
+        vmin=clim[0],
+        vmax=clim[1],
+        aspect=1,
+        cmap="gray",
+        interpolation="nearest",
+        origin="lower",
+    )
+
+    # add the contour overlay
+    cp = ax.contour(x, y, contour_slice, CP_VALS, colors=CP_COLS)
+    ax.clabel(cp, inline=True, fontsize=10, fmt=CLABEL_FMT)
+
+    # add axis orientation labels
+    lims = [0, sizes[xax], 0, sizes[yax]]
+    poss = [
+        [lims[1] / 2.0, lims[3]],
+        [(1 + 0.01) * lims[1], lims[3] / 2.0],
+        [lims[1] / 2.0, 0 - 0.01 * lims[3]],
+        [lims[0] - 0.01 * lims[1], lims[3] / 2.0],
+    ]
+    anchors = [
+        ["center", "bottom"],
+        ["left", "center"],
+        ["center", "top"],
+        ["right", "center"],
+    ]
+    for pos, anchor, lab in zip(poss, anchors, axis_label):
+        ax.text(
+            pos[0],
+            pos[1],
+            lab,
+            horizontalalignment=anchor[0],
+            verticalalignment=anchor[1],
+        )
+
+    # set the size and shape of the axes and turn off ticks
+    ax.axis(lims)
+    ax.set_aspect(aspect_ratio)
+    ax.set_frame_on(False)
+    ax.axes.get_yaxis().set_visible(False)
+    ax.axes.get_xaxis().set_visible(False)
+
 
+def contour(b_fp, c_fp, fig_fp, fig=None, axs=None):
     """
     Create a plot showing a central sagittal, coronal and axial slice through
     a base image with a contour plot overlay
@@ -47,6 +279,10 @@ def contour(b_fp, c_fp, fig_fp):
     :type c_fp: nib.nifti1.Nifti1Image
     :param fig_fp:
     :type fig_fp: pathlib.Path
+    :param fig: Figure to reuse, created (and closed) by contour if None
+    :type fig: matplotlib.figure.Figure
+    :param axs: 2x2 array of axes of fig
+    :type axs: np.ndarray
 
     The resulting plot has the following arrangement on an A4 page:
 
@@ -71,29 +307,34 @@ def contour(b_fp, c_fp, fig_fp):
 
     """
 
-    # load and transform to canonical orientation
-    b_nii = nib.funcs.as_closest_canonical(nib.load(b_fp))
-    c_nii = nib.funcs.as_closest_canonical(nib.load(c_fp))
-
-    # load the transformed image data
-    b = b_nii.get_fdata()
-    c = c_nii.get_fdata()
-
-    # extract image parameters
-    vox_sizes = b_nii.header.get_zooms()
-    clim = np.percentile(b, (1.0, 99.0))
-
-    # set up the figure
-    fig, axs = plt.subplots(2, 2)
+    # load the images
+    b_nii, b_data = load_image(b_fp)
+    c_nii, c_data = load_image(c_fp)
+
+    # extract image parameters in canonical orientation
+    b_axes = canonical_axes(b_nii)
+    sizes = [b_nii.shape[a] for a, _ in b_axes]
+    vox_sizes = [b_nii.header.get_zooms()[a] for a, _ in b_axes]
+
+    # estimate the display range from every 4th voxel along each axis, using
+    # the samples just below the 1st and 99th percentiles (equivalent to
+    # np.quantile with method="lower") as a partial sort is all that's needed
+    sample = np.asarray(b_data[::4, ::4, ::4]).ravel()
+    k = [int(q * (sample.size - 1)) for q in (0.01, 0.99)]
+    clim = np.partition(sample, k)[k]
+
+    # set up the figure, clearing it if it's being reused
+    close_fig = fig is None
+    if close_fig:
+        fig, axs = plt.subplots(2, 2)
+    else:
+        for ax in axs.flat:
+            ax.clear()
     fig.set_size_inches((8.27, 11.70))  # A4
 
     fig_title = "Distortion of %s" % b_fp.name
     fig.suptitle(fig_title, fontweight="bold", fontsize=14)
-    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
-
-    # set the contour plot values and associated colours
-    cp_cols = ["gray"] + ["g"] * 2 + ["orange"] + ["r"] * 4 + ["purple"] * 3
-    cp_vals = [0.1, 0.5, 1.0, 1.5, 2, 3, 4, 5, 10, 15, 20]
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
 
     # lists containing properties for [sagittal, coronal, axial] plots
     axes_list = [axs[0, 0], axs[0, 1], axs[1, 0]]
@@ -103,17 +344,17 @@ def contour(b_fp, c_fp, fig_fp):
         vox_sizes[1] / vox_sizes[0],
     ]
     axis_labels = ["SAIP", "SRIL", "ARPL"]
+    # transpose the slices for plotting and copy them into C-contiguous float32
+    # arrays once, rather than leaving downsample, imshow and contour to copy
+    # them, float32 is ample precision for plotting and halves the memory used
     base_slices = [
-        b[b.shape[0] // 2, :, :].T,
-        b[:, b.shape[1] // 2, :].T,
-        b[:, :, b.shape[2] // 2].T,
+        np.ascontiguousarray(central_slice(b_nii, axis, b_data).T, dtype=np.float32)
+        for axis in range(3)
     ]
     contour_slices = [
-        c[c.shape[0] // 2, :, :].T,
-        c[:, c.shape[1] // 2, :].T,
-        c[:, :, c.shape[2] // 2].T,
+        np.ascontiguousarray(central_slice(c_nii, axis, c_data).T, dtype=np.float32)
+        for axis in range(3)
     ]
-    sizes = list(b.shape)
 
     # loop over the three axes sagittal, coronal then axial
     for ax, xax, yax, aspect_ratio, axis_label, base_slice, contour_slice in zip(
@@ -125,55 +366,21 @@ def contour(b_fp, c_fp, fig_fp):
         base_slices,
         contour_slices,
     ):
-
-        # plot the base image
-        ax.imshow(
+        render_view(
+            ax,
+            xax,
+            yax,
+            aspect_ratio,
+            axis_label,
             base_slice,
-            vmin=clim[0],
-            vmax=clim[1],
-            aspect=1,
-            cmap="gray",
-            interpolation="nearest",
-            origin="lower",
+            contour_slice,
+            clim,
+            sizes,
         )
 
-        # add the contour overlay
-        cp = ax.contour(contour_slice, cp_vals, colors=cp_cols, origin="lower")
-        plt.clabel(cp, inline=1, fontsize=10, fmt="%1.1f")
-
-        # add axis orientation labels
-        lims = [0, sizes[xax], 0, sizes[yax]]
-        poss = [
-            [lims[1] / 2.0, lims[3]],
-            [(1 + 0.01) * lims[1], lims[3] / 2.0],
-            [lims[1] / 2.0, 0 - 0.01 * lims[3]],
-            [lims[0] - 0.01 * lims[1], lims[3] / 2.0],
-        ]
-        anchors = [
-            ["center", "bottom"],
-            ["left", "center"],
-            ["center", "top"],
-            ["right", "center"],
-        ]
-        for pos, anchor, lab in zip(poss, anchors, axis_label):
-            ax.text(
-                pos[0],
-                pos[1],
-                lab,
-                horizontalalignment=anchor[0],
-                verticalalignment=anchor[1],
-            )
-
-        # set the size and shape of the axes and turn off ticks
-        ax.axis(lims)
-        ax.set_aspect(aspect_ratio)
-        ax.set_frame_on(False)
-        ax.axes.get_yaxis().set_visible(False)
-        ax.axes.get_xaxis().set_visible(False)
-
     # ensure the axs[1, 1] is the same size and shape as axs[1, 0]
-    axs[1, 1].axis(lims)
-    axs[1, 1].set_aspect(aspect_ratio)
+    axs[1, 1].axis([0, sizes[0], 0, sizes[1]])
+    axs[1, 1].set_aspect(aspect_ratios[2])
     axs[1, 1].get_yaxis().set_visible(False)
     axs[1, 1].get_xaxis().set_visible(False)
     axs[1, 1].set_frame_on(False)
@@ -194,7 +401,292 @@ def contour(b_fp, c_fp, fig_fp):
         bbox={"facecolor": "gray", "alpha": 0.5, "boxstyle": "round"},
     )
 
-    plt.savefig(fig_fp, orientation="portrait")
+    # render the PDF in memory and write it with a single call, via a
+    # temporary file, so a partially written PDF is never left at fig_fp
+    buf = io.BytesIO()
+    fig.savefig(
+        buf,
+        format="pdf",
+        dpi=100,
+        metadata={"Creator": "geomqa %s" % __version__},
+    )
+    tmp_fp = fig_fp.with_name(fig_fp.name + ".tmp")
+    tmp_fp.write_bytes(buf.getvalue())
+    os.replace(tmp_fp, fig_fp)
+
+    if close_fig:
+        plt.close(fig)
+
+
+def run_steps(steps, prefix="", env=None):
+    """
+    Run a chain of commands in order, skipping any whose output already exists
+
+    :param steps: (message, output filepath, command) for each step, where the
+        command is either a list of program arguments or a Python callable
+    :type steps: list
+    :param prefix: printed at the start of each line of the messages
+    :type prefix: str
+    :param env: environment of the programs, defaults to that of geomqa
+    :type env: dict
+    """
+
+    for msg, out_fp, cmd in steps:
+        for line in msg.splitlines():
+            print(prefix + line)
+        if not out_fp.is_file():
+            if callable(cmd):
+                cmd()
+            else:
+                sp.run(cmd, check=True, env=env)
+
+
+def calc_magnitude(in_fp, out_fp):
+    """
+    Calculate the magnitude of a displacement field at each voxel
+
+    :param in_fp: Filepath of displacement field with the x, y and z components
+        of the displacement along the last axis
+    :type in_fp: pathlib.Path
+    :param out_fp: Filepath of magnitude of displacement field
+    :type out_fp: pathlib.Path
+    """
+
+    disp_nii = nib.load(in_fp)
+    disp = disp_nii.get_fdata(dtype=np.float32)
+    mag = np.linalg.norm(disp.reshape(disp.shape[:3] + (-1,)), axis=-1)
+
+    hdr = disp_nii.header.copy()
+    hdr.set_intent("none")
+    hdr.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(mag, disp_nii.affine, hdr), out_fp)
+
+
+def process_mri(mri_file, out_dp, niftyreg_dp, f3d_opts, display=True):
+    """
+    Register an MRI to the CT of the phantom, calculate the distortion and plot
+    the results, skipping any step whose output already exists
+
+    :param mri_file: Filepath of MRI
+    :type mri_file: pathlib.Path
+    :param out_dp: Results directory
+    :type out_dp: pathlib.Path
+    :param niftyreg_dp: directory containing niftyreg programs
+    :type niftyreg_dp: pathlib.Path
+    :param f3d_opts: options passed to reg_f3d
+    :type f3d_opts: list
+    :param display: display the registered images in mrview
+    :type display: bool
+    :return: Filepath of the PDF of results
+    :rtype: pathlib.Path
+    """
+
+    # paths to niftyreg commands
+    reg_aladin_fp = niftyreg_dp / "reg_aladin"
+    reg_f3d_fp = niftyreg_dp / "reg_f3d"
+    reg_resample_fp = niftyreg_dp / "reg_resample"
+    reg_transform_fp = niftyreg_dp / "reg_transform"
+
+    ct_fp = pathlib.Path(__file__).resolve().parent / "ct.nii.gz"
+    ctmask_fp = pathlib.Path(__file__).resolve().parent / "ctmask.nii.gz"
+
+    mri_fp = mri_file.resolve()
+
+    print("* processing %s" % mri_fp.name)
+    results_dp = out_dp / remove_niigz(mri_fp.name)
+    # several MRIs can be processed at once so label their progress messages
+    prefix = "[%s] " % results_dp.name
+    results_dp.mkdir(parents=True, exist_ok=True)
+
+    # create symlink to CT in results directory for visual check of registration
+    ct_lnk_fp = results_dp / "ct.nii.gz"
+    if not ct_lnk_fp.is_file():
+        ct_lnk_fp.symlink_to(ct_fp)
+
+    # filepaths
+    rigid_fp = results_dp / "mr2ct_rigid.nii.gz"
+    affine_fp = results_dp / "mr2ct_rigid.aff"
+    nonrigid_fp = results_dp / "mr2ct_nonrigid.nii.gz"
+    cpp_fp = results_dp / "mr2ct_cpp.nii.gz"
+    disp_field_fp = results_dp / "displ_field_ct.nii.gz"
+    mag_displ_field_ct_fp = results_dp / "mag_displ_field_ct.nii.gz"
+    mr2ct_deformation_fp = results_dp / "mr2ct_deformation.nii.gz"
+    ct2mr_deformation_fp = results_dp / "ct2mr_deformation.nii.gz"
+    mag_displ_field_mri_fp = results_dp / "mag_displ_field_mri.nii.gz"
+    fig_fp = out_dp / (remove_niigz(mri_fp.name) + "_distortion_results.pdf")
+
+    # generate commands
+    rigid_cmd = [
+        reg_aladin_fp,
+        "-ref",
+        ct_fp,
+        "-flo",
+        mri_fp,
+        "-rmask",
+        ctmask_fp,
+        "-res",
+        rigid_fp,
+        "-rigOnly",
+        "-aff",
+        affine_fp,
+    ]
+
+    nonrigid_cmd = [
+        reg_f3d_fp,
+        "-ref",
+        ct_fp,
+        "-flo",
+        rigid_fp,
+        "-rmask",
+        ctmask_fp,
+        "-res",
+        nonrigid_fp,
+        "-cpp",
+        cpp_fp,
+    ] + f3d_opts
+
+    mrview_cmd = [
+        "mrview",
+        ct_fp,
+        "-voxel",
+        "271,257,134",
+        "-mode",
+        "2",
+        "-intensity_range",
+        "1000,1500",
+        "-overlay.load",
+        rigid_fp,
+        "-overlay.opacity",
+        "0.6",
+        "-overlay.colour",
+        "1,0,0",
+        "-overlay.intensity",
+        "200,4095",
+        "-overlay.threshold_min",
+        "200",
+        "-overlay.load",
+        nonrigid_fp,
+        "-overlay.opacity",
+        "0.6",
+        "-overlay.colour",
+        "0,0,1",
+        "-overlay.intensity",
+        "200,4095",
+        "-overlay.threshold_min",
+        "200",
+    ]
+
+    disp_cmd = [reg_transform_fp, "-ref", ct_fp, "-disp", cpp_fp, disp_field_fp]
+
+    mag_displ_field_cmd = functools.partial(
+        calc_magnitude, disp_field_fp, mag_displ_field_ct_fp
+    )
+
+    compose_cmd = [
+        reg_transform_fp,
+        "-ref",
+        ct_fp,
+        "-comp",
+        affine_fp,
+        cpp_fp,
+        mr2ct_deformation_fp,
+    ]
+
+    invert_cmd = [
+        reg_transform_fp,
+        "-ref",
+        ct_fp,
+        "-invNrr",
+        mr2ct_deformation_fp,
+        mri_fp,
+        ct2mr_deformation_fp,
+    ]
+
+    resample_cmd = [
+        reg_resample_fp,
+        "-ref",
+        mri_fp,
+        "-flo",
+        mag_displ_field_ct_fp,
+        "-trans",
+        ct2mr_deformation_fp,
+        "-res",
+        mag_displ_field_mri_fp,
+        "-inter",
+        "1",
+    ]
+
+    # run commands
+    print(prefix + "** registering MRI to CT")
+    print(prefix + "*** rigid registration with reg_aladin")
+    if not rigid_fp.is_file():
+        sp.run(rigid_cmd, check=True)
+
+    print(prefix + "*** non-rigid registration with reg_f3d")
+    if not nonrigid_fp.is_file():
+        sp.run(nonrigid_cmd, check=True)
+
+        if display:
+            # mrview's output is never read so discard it, rather than letting
+            # it fill a pipe and block the viewer, and run it in its own
+            # session so it can outlive geomqa
+            print(prefix + "*** displaying registered images with mrview")
+            sp.Popen(
+                mrview_cmd,
+                stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL,
+                start_new_session=True,
+            )
+
+    # the CT-space displacement field and the inverse of the MRI to CT
+    # transformation are independent so calculate them at the same time
+    ct_steps = [
+        (
+            "** calculating displacement field in CT-space with reg_transform",
+            disp_field_fp,
+            disp_cmd,
+        ),
+        (
+            "** calculating root mean square of displacement field in CT-space",
+            mag_displ_field_ct_fp,
+            mag_displ_field_cmd,
+        ),
+    ]
+    mri_steps = [
+        (
+            "** transforming results into MRI space\n"
+            "*** composing mr2ct_rigid.aff and mr2ct_cpp.nii.gz with reg_transform",
+            mr2ct_deformation_fp,
+            compose_cmd,
+        ),
+        (
+            "*** inverting composed transformation with reg_transform",
+            ct2mr_deformation_fp,
+            invert_cmd,
+        ),
+    ]
+
+    # split this job's share of the cores between the two chains
+    omp_threads = int(os.environ.get("OMP_NUM_THREADS", os.cpu_count() or 1))
+    chain_env = dict(os.environ, OMP_NUM_THREADS=str(max(1, omp_threads // 2)))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(run_steps, steps, prefix, chain_env)
+            for steps in (ct_steps, mri_steps)
+        ]
+        for future in futures:
+            future.result()
+
+    print(prefix + "*** resampling into MRI space with reg_resample")
+    if not mag_displ_field_mri_fp.is_file():
+        sp.run(resample_cmd, check=True)
+
+    print(prefix + "** plotting results")
+    if not fig_fp.is_file():
+        contour(mri_fp, mag_displ_field_mri_fp, fig_fp)
+
+    return fig_fp
 
 
 def main():
@@ -254,6 +746,13 @@ def main():
         type=int,
     )
 
+    parser.add_argument(
+        "-jobs",
+        default=max(1, (os.cpu_count() or 1) // 4),
+        help="number of MRI files to process in parallel (default: %(default)s)",
+        type=positive_int,
+    )
+
     parser.add_argument(
         "--version",
         action="version",
@@ -268,21 +767,38 @@ def main():
         help="don't abort if version checks of external software fail",
     )
 
+    parser.add_argument(
+        "--no-display",
+        dest="no_display",
+        default=False,
+        action="store_true",
+        help="don't display the registered images in mrview",
+    )
+
     if len(sys.argv) == 1:
         sys.argv.append("-h")
 
     args = parser.parse_args()
 
-    be_opt = args.be
-    maxit_opt = args.maxit
-    ln_opt = args.ln
-    lp_opt = args.lp
-    sx_opt = args.sx
+    # each MRI's results are stored in a directory named after the file it
+    # resolves to so files with the same name would overwrite each other's results
+    names = [remove_niigz(mri_file.resolve().name) for mri_file in args.n]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        parser.error("MRI files must have unique names, got %s" % ", ".join(duplicates))
+
+    # mrview needs an X display, so skip it in headless runs e.g. batch jobs
+    display = not args.no_display and bool(os.environ.get("DISPLAY"))
 
     print("* checking versions of external software")
-    vercheck.check_lib_ver(
-        "MRtrix", vercheck.get_mrtrix_ver(), config.MRTRIX_VERSIONS, args.any_version
-    )
+    # mrview is the only MRtrix program used, so MRtrix isn't needed without it
+    if display:
+        vercheck.check_lib_ver(
+            "MRtrix",
+            vercheck.get_mrtrix_ver(),
+            config.MRTRIX_VERSIONS,
+            args.any_version,
+        )
 
     niftyreg_dp = args.niftyreg
     vercheck.check_lib_ver(
@@ -292,195 +808,42 @@ def main():
         args.any_version,
     )
 
-    # paths to niftyreg commands
-    reg_aladin_fp = niftyreg_dp / "reg_aladin"
-    reg_f3d_fp = niftyreg_dp / "reg_f3d"
-    reg_resample_fp = niftyreg_dp / "reg_resample"
-    reg_transform_fp = niftyreg_dp / "reg_transform"
+    f3d_opts = [
+        "-be",
+        str(args.be),
+        "-maxit",
+        str(args.maxit),
+        "-sx",
+        str(args.sx),
+        "-ln",
+        str(args.ln),
+        "-lp",
+        str(args.lp),
+    ]
 
-    ct_fp = pathlib.Path(__file__).resolve().parent / "ct.nii.gz"
-    ctmask_fp = pathlib.Path(__file__).resolve().parent / "ctmask.nii.gz"
+    # share the cores between the parallel jobs so the multi-threaded (OpenMP)
+    # niftyreg programs don't oversubscribe the CPU (process_mri halves this
+    # again while it runs two reg_transform chains at once)
+    os.environ.setdefault(
+        "OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // args.jobs))
+    )
 
     # directory to store intermediate images e.g. result of rigid registration
     out_dp = args.o.resolve()
 
-    for mri_file in sorted(args.n):
-        mri_fp = mri_file.resolve()
-
-        print("* processing %s" % mri_fp.name)
-        results_dp = out_dp / remove_niigz(mri_fp.name)
-        results_dp.mkdir(parents=True, exist_ok=True)
-
-        # create symlink to CT in results directory for visual check of registration
-        ct_lnk_fp = results_dp / "ct.nii.gz"
-        if not ct_lnk_fp.is_file():
-            ct_lnk_fp.symlink_to(ct_fp)
-
-        # filepaths
-        rigid_fp = results_dp / "mr2ct_rigid.nii.gz"
-        affine_fp = results_dp / "mr2ct_rigid.aff"
-        nonrigid_fp = results_dp / "mr2ct_nonrigid.nii.gz"
-        cpp_fp = results_dp / "mr2ct_cpp.nii.gz"
-        disp_field_fp = results_dp / "displ_field_ct.nii.gz"
-        mag_displ_field_ct_fp = results_dp / "mag_displ_field_ct.nii.gz"
-        mr2ct_deformation_fp = results_dp / "mr2ct_deformation.nii.gz"
-        ct2mr_deformation_fp = results_dp / "ct2mr_deformation.nii.gz"
-        mag_displ_field_mri_fp = results_dp / "mag_displ_field_mri.nii.gz"
-        fig_fp = out_dp / (remove_niigz(mri_fp.name) + "_distortion_results.pdf")
-
-        # generate commands
-        rigid_cmd = [
-            reg_aladin_fp,
-            "-ref",
-            ct_fp,
-            "-flo",
-            mri_fp,
-            "-rmask",
-            ctmask_fp,
-            "-res",
-            rigid_fp,
-            "-rigOnly",
-            "-aff",
-            affine_fp,
-        ]
-
-        nonrigid_cmd = [
-            reg_f3d_fp,
-            "-ref",
-            ct_fp,
-            "-flo",
-            rigid_fp,
-            "-rmask",
-            ctmask_fp,
-            "-res",
-            nonrigid_fp,
-            "-cpp",
-            cpp_fp,
-            "-be",
-            str(be_opt),
-            "-maxit",
-            str(maxit_opt),
-            "-sx",
-            str(sx_opt),
-            "-ln",
-            str(ln_opt),
-            "-lp",
-            str(lp_opt),
-        ]
-
-        mrview_cmd = [
-            "mrview",
-            ct_fp,
-            "-voxel",
-            "271,257,134",
-            "-mode",
-            "2",
-            "-intensity_range",
-            "1000,1500",
-            "-overlay.load",
-            rigid_fp,
-            "-overlay.opacity",
-            "0.6",
-            "-overlay.colour",
-            "1,0,0",
-            "-overlay.intensity",
-            "200,4095",
-            "-overlay.threshold_min",
-            "200",
-            "-overlay.load",
-            nonrigid_fp,
-            "-overlay.opacity",
-            "0.6",
-            "-overlay.colour",
-            "0,0,1",
-            "-overlay.intensity",
-            "200,4095",
-            "-overlay.threshold_min",
-            "200",
-        ]
-
-        disp_cmd = [reg_transform_fp, "-ref", ct_fp, "-disp", cpp_fp, disp_field_fp]
-
-        mag_displ_field_cmd = [
-            "mrmath",
-            "-axis",
-            "4",
-            disp_field_fp,
-            "norm",
-            mag_displ_field_ct_fp,
-        ]
-
-        compose_cmd = [
-            reg_transform_fp,
-            "-ref",
-            ct_fp,
-            "-comp",
-            affine_fp,
-            cpp_fp,
-            mr2ct_deformation_fp,
-        ]
-
-        invert_cmd = [
-            reg_transform_fp,
-            "-ref",
-            ct_fp,
-            "-invNrr",
-            mr2ct_deformation_fp,
-            mri_fp,
-            ct2mr_deformation_fp,
-        ]
-
-        resample_cmd = [
-            reg_resample_fp,
-            "-ref",
-            mri_fp,
-            "-flo",
-            mag_displ_field_ct_fp,
-            "-trans",
-            ct2mr_deformation_fp,
-            "-res",
-            mag_displ_field_mri_fp,
-            "-inter",
-            "1",
-        ]
-
-        # run commands
-        print("** registering MRI to CT")
-        print("*** rigid registration with reg_aladin")
-        if not rigid_fp.is_file():
-            sp.run(rigid_cmd, check=True)
-
-        print("*** non-rigid registration with reg_f3d")
-        if not nonrigid_fp.is_file():
-            sp.run(nonrigid_cmd, check=True)
-
-            print("*** displaying registered images with mrview")
-            sp.Popen(mrview_cmd, stderr=sp.PIPE, stdout=sp.PIPE)
-
-        print("** calculating displacement field in CT-space with reg_transform")
-        if not disp_field_fp.is_file():
-            sp.run(disp_cmd, check=True)
-
-        print("** calculating root mean square of displacement field in CT-space")
-        if not mag_displ_field_ct_fp.is_file():
-            sp.run(mag_displ_field_cmd, check=True)
-
-        print("** transforming results into MRI space")
-        print("*** composing mr2ct_rigid.aff and mr2ct_cpp.nii.gz with reg_transform")
-        if not mr2ct_deformation_fp.is_file():
-            sp.run(compose_cmd, check=True)
-
-        print("*** inverting composed transformation with reg_transform")
-        if not ct2mr_deformation_fp.is_file():
-            sp.run(invert_cmd, check=True)
-
-        print("*** resampling into MRI space with reg_resample")
-        if not mag_displ_field_mri_fp.is_file():
-            sp.run(resample_cmd, check=True)
-
-        print("** plotting results")
-        if not fig_fp.is_file():
-            contour(mri_fp, mag_displ_field_mri_fp, fig_fp)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            mri_file: executor.submit(
+                process_mri, mri_file, out_dp, niftyreg_dp, f3d_opts, display
+            )
+            for mri_file in sorted(args.n)
+        }
+        for mri_file, future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                sys.stderr.write("ERROR: processing %s failed\n" % mri_file)
+                raise
 
 
 if __name__ == "__main__":  # pragma: no cover
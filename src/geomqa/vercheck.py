@@ -1,6 +1,30 @@
+import functools
+import os
+import re
+import shutil
 import subprocess as sp
 import sys
 
+# First line of mrinfo -version should be of the form == mrinfo 3.0.1-26-g0f28beae ==
+MRINFO_VER_RE = re.compile(r"mrinfo\s+(\S+)")
+
+
+@functools.lru_cache(maxsize=None)
+def run_version_cmd(cmd_fp, mtime):
+    """
+    Run a program with the -version option, caching the output
+
+    :param cmd_fp: path to program
+    :type cmd_fp: str
+    :param mtime: modification time of program, so the cache is refreshed if
+        the program changes
+    :type mtime: float
+    :return: standard output of program
+    :rtype: str
+    """
+
+    return sp.run([cmd_fp, "-version"], capture_output=True, text=True).stdout
+
 
 def get_mrtrix_ver():
     """
@@ -10,22 +34,19 @@ def get_mrtrix_ver():
     :rtype: str
     """
 
-    try:
-        sp_out = sp.run(
-            ["mrinfo", "-version"], capture_output=True, text=True, check=True
-        )
-    except FileNotFoundError:
+    mrinfo_fp = shutil.which("mrinfo")
+    if mrinfo_fp is None:
         sys.stderr.write(
             "ERROR: mrinfo (an mrtrix command) used to check "
             "version is not in your path, exiting\n"
         )
         sys.exit(1)
 
-    mrinfo_out = sp_out.stdout.strip()
-    mrinfo_out_first_line = mrinfo_out.splitlines()[0]
+    match = MRINFO_VER_RE.search(
+        run_version_cmd(mrinfo_fp, os.stat(mrinfo_fp).st_mtime)
+    )
 
-    # First line should be of the form == mrinfo 3.0.1-26-g0f28beae ==
-    return mrinfo_out_first_line.split(" ")[2]
+    return match.group(1) if match else "unknown"
 
 
 def get_niftyreg_ver(niftyreg_dp):
@@ -40,10 +61,9 @@ def get_niftyreg_ver(niftyreg_dp):
     if not niftyreg_dp.is_dir():
         raise FileNotFoundError("niftyreg not found")
 
-    reg_aladin_fp = niftyreg_dp / "reg_aladin"
-    sp_out = sp.run([reg_aladin_fp, "-version"], capture_output=True, text=True)
+    reg_aladin_fp = str(niftyreg_dp / "reg_aladin")
 
-    return sp_out.stdout.strip()
+    return run_version_cmd(reg_aladin_fp, os.stat(reg_aladin_fp).st_mtime).strip()
 
 
 def check_lib_ver(lib_name, lib_ver, expected_lib_ver_list, any_ver):
@@ -54,8 +74,8 @@ def check_lib_ver(lib_name, lib_ver, expected_lib_ver_list, any_ver):
     :type lib_name: str
     :param lib_ver: version of library
     :type lib_ver: str
-    :param expected_lib_ver_list: expected version of library
-    :type expected_lib_ver_list: list
+    :param expected_lib_ver_list: expected versions of library
+    :type expected_lib_ver_list: frozenset
     :param any_ver: don't abort if any_ver is True
     :rtype: bool
     """
@@ -63,7 +83,10 @@ def check_lib_ver(lib_name, lib_ver, expected_lib_ver_list, any_ver):
         print("** PASS version check on %s (%s)" % (lib_name, lib_ver))
     else:
         print("** FAIL using non-validated %s version" % lib_name)
-        print("*** expected %s, got %s" % (" or ".join(expected_lib_ver_list), lib_ver))
+        print(
+            "*** expected %s, got %s"
+            % (" or ".join(sorted(expected_lib_ver_list)), lib_ver)
+        )
 
         if not any_ver:
             sys.stderr.write("** exiting\n")
@@ -3,8 +3,8 @@ import geomqa.config as config
 
 def test_config():
 
-    assert isinstance(config.MRTRIX_VERSIONS, list)
-    assert isinstance(config.MRTRIX_VERSIONS[0], str)
-    assert isinstance(config.NIFTYREG_VERSIONS, list)
-    assert isinstance(config.NIFTYREG_VERSIONS[0], str)
+    assert isinstance(config.MRTRIX_VERSIONS, frozenset)
+    assert all(isinstance(v, str) for v in config.MRTRIX_VERSIONS)
+    assert isinstance(config.NIFTYREG_VERSIONS, frozenset)
+    assert all(isinstance(v, str) for v in config.NIFTYREG_VERSIONS)
     assert isinstance(config.DEFAULT_NIFTYREG, str)
@@ -1,5 +1,6 @@
 import pathlib
 
+import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
 import pytest
@@ -32,12 +33,138 @@ def perror(r, t):
 
 @pytest.mark.parametrize(
     "string, expected_output",
-    [("a", "a"), ("a.b", "a.b"), ("a.nii", "a"), ("a.nii.gz", "a")],
+    [
+        ("a", "a"),
+        ("a.b", "a.b"),
+        ("a.nii", "a"),
+        ("a.nii.gz", "a"),
+        ("a.NII.GZ", "a"),
+        ("a.nii.gz.b", "a.nii.gz.b"),
+    ],
 )
 def test_remove_niigz(string, expected_output):
     assert geomqa.remove_niigz(string) == expected_output
 
 
+@pytest.mark.parametrize(
+    "shape, max_dim, expected_shape, expected_f",
+    [
+        ((4, 6), 6, (4, 6), 1),
+        ((4, 6), 3, (2, 3), 2),
+        ((6, 7), 3, (2, 2), 3),
+        ((3, 600), 256, (3, 600), 1),
+        ((600, 5), 256, (600, 5), 1),
+    ],
+)
+def test_downsample(shape, max_dim, expected_shape, expected_f):
+    a = np.arange(np.prod(shape), dtype=float).reshape(shape)
+    a_ds, f = geomqa.downsample(a, max_dim)
+    assert a_ds.shape == expected_shape
+    assert f == expected_f
+    assert a_ds[0, 0] == np.mean(a[:f, :f])
+
+
+@pytest.mark.parametrize(
+    "affine",
+    [
+        np.diag([2.0, 3.0, 4.0, 1.0]),
+        np.diag([-2.0, -3.0, 4.0, 1.0]),
+        np.array(
+            [
+                [0.0, 0.0, -4.0, 0.0],
+                [2.0, 0.0, 0.0, 0.0],
+                [0.0, -3.0, 0.0, 0.0],
+                [0.0, 0.0, 0.0, 1.0],
+            ]
+        ),
+    ],
+)
+def test_central_slice(affine):
+    data = np.arange(5 * 6 * 7, dtype=np.int16).reshape((5, 6, 7))
+    img = nib.Nifti1Image(data, affine)
+    canonical = nib.funcs.as_closest_canonical(img).get_fdata()
+    expected = [
+        canonical[canonical.shape[0] // 2, :, :],
+        canonical[:, canonical.shape[1] // 2, :],
+        canonical[:, :, canonical.shape[2] // 2],
+    ]
+
+    for axis in range(3):
+        assert np.array_equal(geomqa.central_slice(img, axis), expected[axis])
+        assert np.array_equal(
+            geomqa.central_slice(img, axis, np.asanyarray(img.dataobj)),
+            expected[axis],
+        )
+
+
+@pytest.mark.parametrize(
+    "filename, is_array", [("img.nii", False), ("img.nii.gz", True)]
+)
+def test_load_image(tmp_path, filename, is_array):
+    data = np.arange(5 * 6 * 7, dtype=np.int16).reshape((5, 6, 7))
+    img_fp = tmp_path / filename
+    nib.save(nib.Nifti1Image(data, np.eye(4)), img_fp)
+
+    img, img_data = geomqa.load_image(img_fp)
+    assert isinstance(img_data, np.ndarray) == is_array
+    assert np.array_equal(np.asarray(img_data), data)
+    assert np.asarray(img_data[::2, ::2, ::2]).dtype == np.int16
+
+
+def test_run_steps(tmp_path, capsys):
+    exists_fp = tmp_path / "exists.txt"
+    exists_fp.write_text("original")
+    new_fp = tmp_path / "new.txt"
+
+    new_py_fp = tmp_path / "new_py.txt"
+
+    steps = [
+        ("step 1", exists_fp, ["sh", "-c", "echo changed > %s" % exists_fp]),
+        ("step 2", new_fp, ["touch", new_fp]),
+        ("step 3", new_py_fp, new_py_fp.touch),
+    ]
+    geomqa.run_steps(steps)
+
+    assert capsys.readouterr().out == "step 1\nstep 2\nstep 3\n"
+    assert exists_fp.read_text() == "original"
+    assert new_fp.is_file()
+    assert new_py_fp.is_file()
+
+    steps = [("step 1\nstep 1a", exists_fp, None), ("step 2", new_fp, None)]
+    geomqa.run_steps(steps, "[a] ")
+    assert capsys.readouterr().out == "[a] step 1\n[a] step 1a\n[a] step 2\n"
+
+    env_fp = tmp_path / "env.txt"
+    steps = [("step 1", env_fp, ["sh", "-c", "echo $OMP_NUM_THREADS > %s" % env_fp])]
+    geomqa.run_steps(steps, env={"OMP_NUM_THREADS": "3"})
+    assert env_fp.read_text() == "3\n"
+
+
+def test_calc_magnitude(tmp_path):
+
+    ref_results_dir = TEST_DATA_DIR / "qa_example" / "output" / "mri"
+    disp_field_fp = ref_results_dir / "displ_field_ct_ax_134.nii.gz"
+    ref_mag_displ_field_ct_fp = ref_results_dir / "mag_displ_field_ct_ax_134.nii.gz"
+    mag_displ_field_ct_fp = tmp_path / "mag_displ_field_ct.nii.gz"
+
+    geomqa.calc_magnitude(disp_field_fp, mag_displ_field_ct_fp)
+
+    assert mag_displ_field_ct_fp.is_file()
+    ref_mag_displ_field_ct_nii = nib.load(ref_mag_displ_field_ct_fp)
+    mag_displ_field_ct_nii = nib.load(mag_displ_field_ct_fp)
+    assert mag_displ_field_ct_nii.shape == ref_mag_displ_field_ct_nii.shape
+    assert np.allclose(
+        mag_displ_field_ct_nii.affine, ref_mag_displ_field_ct_nii.affine, atol=1e-4
+    )
+    assert (
+        perror(
+            ref_mag_displ_field_ct_nii.get_fdata(),
+            mag_displ_field_ct_nii.get_fdata(),
+        )
+        < 1.0
+    )
+
+
 def test_contour(tmp_path):
 
     fig_fp = tmp_path / "contour.pdf"
@@ -46,6 +173,87 @@ def test_contour(tmp_path):
     ref_mag_displ_field_mri_fp = data_dir / "input" / "contour.nii.gz"
     geomqa.contour(qa_nii, ref_mag_displ_field_mri_fp, fig_fp)
     assert fig_fp.is_file()
+    assert fig_fp.read_bytes().startswith(b"%PDF")
+    assert list(tmp_path.iterdir()) == [fig_fp]
+    assert plt.get_fignums() == []
+
+
+def test_contour_labels(tmp_path):
+
+    data_dir = TEST_DATA_DIR / "qa_example"
+    qa_nii = data_dir / "input" / "mri.nii.gz"
+    ref_mag_displ_field_mri_fp = data_dir / "input" / "contour.nii.gz"
+
+    fig, axs = plt.subplots(2, 2)
+    geomqa.contour(qa_nii, ref_mag_displ_field_mri_fp, tmp_path / "c.pdf", fig, axs)
+
+    for ax in [axs[0, 0], axs[0, 1], axs[1, 0]]:
+        # the last four texts are the orientation labels
+        labels = ax.texts[:-4]
+        assert 0 < len(labels) <= 40
+        xlim = ax.get_xlim()
+        ylim = ax.get_ylim()
+        for label in labels:
+            x, y = label.get_position()
+            assert xlim[0] <= x <= xlim[1]
+            assert ylim[0] <= y <= ylim[1]
+
+    plt.close(fig)
+
+
+def test_contour_short_lines_not_labelled(tmp_path):
+
+    # 256 small bumps in the distortion, each giving a contour line that's too
+    # short to hold a label
+    x, y = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    c = np.zeros((256, 256))
+    for cx in range(8, 256, 16):
+        for cy in range(8, 256, 16):
+            c += 0.3 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / 2.0)
+    c = np.repeat(c[:, :, np.newaxis], 16, axis=2)
+
+    b_fp = tmp_path / "b.nii.gz"
+    c_fp = tmp_path / "c.nii.gz"
+    nib.save(nib.Nifti1Image(np.ones(c.shape, dtype=np.float32), np.eye(4)), b_fp)
+    nib.save(nib.Nifti1Image(c.astype(np.float32), np.eye(4)), c_fp)
+
+    fig, axs = plt.subplots(2, 2)
+    geomqa.contour(b_fp, c_fp, tmp_path / "c.pdf", fig, axs)
+
+    # the last four texts of the axial view are the orientation labels
+    assert len(axs[1, 0].texts[:-4]) < 10
+
+    plt.close(fig)
+
+
+def test_contour_thin_slab(tmp_path):
+
+    rng = np.random.default_rng(0)
+    b_fp = tmp_path / "b.nii.gz"
+    c_fp = tmp_path / "c.nii.gz"
+    nib.save(nib.Nifti1Image(rng.random((600, 600, 3)), np.eye(4)), b_fp)
+    nib.save(nib.Nifti1Image(rng.random((600, 600, 3)), np.eye(4)), c_fp)
+
+    fig_fp = tmp_path / "contour.pdf"
+    geomqa.contour(b_fp, c_fp, fig_fp)
+    assert fig_fp.is_file()
+
+
+def test_contour_reuse_figure(tmp_path):
+
+    data_dir = TEST_DATA_DIR / "qa_example"
+    qa_nii = data_dir / "input" / "mri.nii.gz"
+    ref_mag_displ_field_mri_fp = data_dir / "input" / "contour.nii.gz"
+
+    fig, axs = plt.subplots(2, 2)
+    for i in range(2):
+        fig_fp = tmp_path / ("contour_%d.pdf" % i)
+        geomqa.contour(qa_nii, ref_mag_displ_field_mri_fp, fig_fp, fig, axs)
+        assert fig_fp.is_file()
+        assert len(axs[1, 1].texts) == 1
+
+    assert plt.fignum_exists(fig.number)
+    plt.close(fig)
 
 
 def test_prints_help_1(script_runner):
@@ -66,6 +274,110 @@ def test_prints_help_for_invalid_option(script_runner):
     assert result.stderr.startswith(SCRIPT_USAGE)
 
 
+@pytest.mark.parametrize("jobs", ["0", "-1", "a"])
+def test_invalid_jobs(tmp_path, script_runner, jobs):
+    qa_nii = TEST_DATA_DIR / "qa_example" / "input" / "mri.nii.gz"
+    result = script_runner.run(SCRIPT_NAME, str(qa_nii), str(tmp_path), "-jobs", jobs)
+    assert not result.success
+    assert result.stderr.startswith(SCRIPT_USAGE)
+    assert "-jobs" in result.stderr
+
+
+def test_duplicate_names(tmp_path, script_runner):
+    result = script_runner.run(
+        SCRIPT_NAME,
+        str(tmp_path / "a" / "mri.nii.gz"),
+        str(tmp_path / "b" / "mri.nii"),
+        str(tmp_path),
+    )
+    assert not result.success
+    assert result.stderr.startswith(SCRIPT_USAGE)
+    assert "MRI files must have unique names, got mri" in result.stderr
+
+
+def test_duplicate_names_symlinks(tmp_path, script_runner):
+    qa_nii = TEST_DATA_DIR / "qa_example" / "input" / "mri.nii.gz"
+
+    # links with different names to the same file share a results directory
+    (tmp_path / "scan1.nii.gz").symlink_to(qa_nii)
+    (tmp_path / "scan2.nii.gz").symlink_to(qa_nii)
+    result = script_runner.run(
+        SCRIPT_NAME,
+        str(tmp_path / "scan1.nii.gz"),
+        str(tmp_path / "scan2.nii.gz"),
+        str(tmp_path / "out"),
+    )
+    assert not result.success
+    assert result.stderr.startswith(SCRIPT_USAGE)
+    assert "MRI files must have unique names, got mri" in result.stderr
+
+    # links with the same name to different files don't
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    (tmp_path / "a" / "scan.nii.gz").symlink_to(qa_nii)
+    (tmp_path / "b" / "scan.nii.gz").symlink_to(tmp_path / "other.nii.gz")
+    result = script_runner.run(
+        SCRIPT_NAME,
+        str(tmp_path / "a" / "scan.nii.gz"),
+        str(tmp_path / "b" / "scan.nii.gz"),
+        str(tmp_path / "out"),
+        "-niftyreg",
+        str(tmp_path / "no_niftyreg"),
+    )
+    assert "MRI files must have unique names" not in result.stderr
+
+
+@pytest.mark.parametrize(
+    "display_env, opts, checks_mrtrix",
+    [
+        ("", [], False),
+        (":0", ["--no-display"], False),
+        (":0", [], True),
+    ],
+)
+def test_mrtrix_only_checked_for_display(
+    tmp_path, script_runner, monkeypatch, display_env, opts, checks_mrtrix
+):
+    monkeypatch.setenv("PATH", "")
+    monkeypatch.setenv("DISPLAY", display_env)
+    qa_nii = TEST_DATA_DIR / "qa_example" / "input" / "mri.nii.gz"
+    result = script_runner.run(
+        SCRIPT_NAME,
+        str(qa_nii),
+        str(tmp_path),
+        "-niftyreg",
+        str(tmp_path / "no_niftyreg"),
+        *opts,
+    )
+    assert not result.success
+    assert ("mrinfo (an mrtrix command)" in result.stderr) == checks_mrtrix
+    assert ("niftyreg not found" in result.stderr) != checks_mrtrix
+
+
+def test_failed_mri_named(tmp_path, script_runner):
+    qa_nii = TEST_DATA_DIR / "qa_example" / "input" / "mri.nii.gz"
+
+    # reg_aladin that reports a validated version but fails to register
+    niftyreg_dp = tmp_path / "niftyreg"
+    niftyreg_dp.mkdir()
+    reg_aladin_fp = niftyreg_dp / "reg_aladin"
+    reg_aladin_fp.write_text(
+        '#!/bin/sh\n[ "$1" = "-version" ] && echo 1.5.59 && exit 0\nexit 1\n'
+    )
+    reg_aladin_fp.chmod(0o755)
+
+    result = script_runner.run(
+        SCRIPT_NAME,
+        str(qa_nii),
+        str(tmp_path / "out"),
+        "-niftyreg",
+        str(niftyreg_dp),
+        "--no-display",
+    )
+    assert not result.success
+    assert "ERROR: processing %s failed" % qa_nii in result.stderr
+
+
 def test_geomqa_files_exist(tmp_path, script_runner):
 
     data_dir = TEST_DATA_DIR / "qa_example"
@@ -27,6 +27,39 @@ def test_get_mrtrix_ver(capsys):
         )
 
 
+@pytest.mark.parametrize(
+    "stdout, expected_ver",
+    [
+        ("== mrinfo 3.0.4-10-gf633dfd7 ==\n", "3.0.4-10-gf633dfd7"),
+        ("==  mrinfo\t 3.0.4-10-gf633dfd7   ==\nmore output\n", "3.0.4-10-gf633dfd7"),
+        ("something unexpected\n", "unknown"),
+    ],
+)
+def test_get_mrtrix_ver_parse(tmp_path, stdout, expected_ver):
+    mrinfo_fp = tmp_path / "mrinfo"
+    mrinfo_fp.touch()
+    with mock.patch.object(
+        vercheck.shutil, "which", return_value=str(mrinfo_fp)
+    ), mock.patch.object(vercheck, "run_version_cmd", return_value=stdout):
+        assert vercheck.get_mrtrix_ver() == expected_ver
+
+
+def test_run_version_cmd():
+    vercheck.run_version_cmd.cache_clear()
+    with mock.patch.object(vercheck.sp, "run") as mock_run:
+        mock_run.return_value.stdout = "1.0.0\n"
+
+        assert vercheck.run_version_cmd("prog", 1.0) == "1.0.0\n"
+        assert vercheck.run_version_cmd("prog", 1.0) == "1.0.0\n"
+        assert mock_run.call_count == 1
+
+        # program modified so run it again
+        assert vercheck.run_version_cmd("prog", 2.0) == "1.0.0\n"
+        assert mock_run.call_count == 2
+
+    vercheck.run_version_cmd.cache_clear()
+
+
 def test_get_niftyreg_ver():
     niftyreg_dp = pathlib.Path(config.DEFAULT_NIFTYREG)
     assert vercheck.get_niftyreg_ver(niftyreg_dp) in config.NIFTYREG_VERSIONS
@@ -63,6 +96,14 @@ def test_check_lib_ver(capsys):
         "expected 1.0.0 or 1.0.1, got 2.0.0\n"
     )
 
+    # Expected versions listed in a stable order
+    vercheck.check_lib_ver("lib_a", "2.0.0", frozenset({"1.0.1", "1.0.0"}), True)
+    captured = capsys.readouterr()
+    assert (
+        captured.out == "** FAIL using non-validated lib_a version\n*** "
+        "expected 1.0.0 or 1.0.1, got 2.0.0\n"
+    )
+
     # Library check pass and don't exit
     vercheck.check_lib_ver("lib_a", "2.0.0", ["1.0.0", "2.0.0"], True)
     captured = capsys.readouterr()